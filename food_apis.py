@@ -8,11 +8,65 @@ import time
 import re
 import requests
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 FATSECRET_CLIENT_ID = os.environ.get('FATSECRET_CLIENT_ID', '')
 FATSECRET_CLIENT_SECRET = os.environ.get('FATSECRET_CLIENT_SECRET', '')
 USDA_API_KEY = os.environ.get('USDA_API_KEY', 'DEMO_KEY')
 
+# One pooled session for all upstream calls so warm instances reuse
+# keep-alive TLS connections instead of handshaking on every request.
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Retry gateway errors, but never a read timeout: that would stack 8s waits
+    max_retries=Retry(total=2, connect=1, read=0, backoff_factor=0.2,
+                      status_forcelist=[502, 503, 504]),
+))
+
+
+class Cooldown:
+    """Skips one upstream API for a while after it answers 429.
+
+    FatSecret and USDA meter quota per day and per hour, so pacing calls
+    locally would throttle ordinary bursts long before the real limit. Every
+    call goes out until the upstream reports we are over quota; after that the
+    provider is skipped for Retry-After seconds, or `default` when the header
+    is missing.
+    """
+
+    def __init__(self, default: float):
+        self.default = default
+        self._until = 0.0
+
+    def active(self) -> bool:
+        return time.monotonic() < self._until
+
+    def trip(self, retry_after: str | None = None) -> None:
+        seconds = int(retry_after) if retry_after and retry_after.isdigit() else self.default
+        self._until = time.monotonic() + seconds
+
+
+# FatSecret basic tier: 5000 calls/day. USDA: 1000/hour with a key, 30/hour on DEMO_KEY.
+_fatsecret_cooldown = Cooldown(default=3600)
+_usda_cooldown = Cooldown(default=3600)
+
+# USDA nutrientName -> product field. Records carry 30-50 nutrients; only
+# these are read.
+USDA_NUTRIENTS = {
+    'Energy': 'calories',
+    'Protein': 'protein',
+    'Carbohydrate, by difference': 'carbs',
+    'Total lipid (fat)': 'fat',
+    'Fiber, total dietary': 'fiber',
+    'Sugars, total including NLEA': 'sugar',
+    'Sodium, Na': 'sodium',
+}
+# Older records only have the plain sugar total
+USDA_SUGAR_FALLBACK = 'Sugars, total'
+
 _fatsecret_token = {
     'access_token': None,
     'expires_at': 0.0,
@@ -29,7 +83,7 @@ def get_fatsecret_token() -> str | None:
         return _fatsecret_token['access_token']
 
     try:
-        resp = requests.post(
+        resp = _http.post(
             'https://oauth.fatsecret.com/connect/token',
             data={
                 'grant_type': 'client_credentials',
@@ -70,11 +124,11 @@ def _parse_fatsecret_description(desc: str) -> dict:
 def search_fatsecret(query: str) -> list[dict]:
     """Call FatSecret foods.search, return normalized product dicts."""
     token = get_fatsecret_token()
-    if not token:
+    if not token or _fatsecret_cooldown.active():
         return []
 
     try:
-        resp = requests.get(
+        resp = _http.get(
             'https://platform.fatsecret.com/rest/server.api',
             headers={'Authorization': f'Bearer {token}'},
             params={
@@ -85,6 +139,8 @@ def search_fatsecret(query: str) -> list[dict]:
             },
             timeout=8,
         )
+        if resp.status_code == 429:
+            _fatsecret_cooldown.trip(resp.headers.get('Retry-After'))
         if resp.status_code != 200:
             return []
 
@@ -118,19 +174,24 @@ def search_fatsecret(query: str) -> list[dict]:
         return []
 
 
-def search_usda(query: str) -> list[dict]:
+def search_usda(query: str, page_size: int = 15) -> list[dict]:
     """USDA FoodData Central search — returns normalized product dicts."""
+    if _usda_cooldown.active():
+        return []
+
     try:
-        resp = requests.get(
+        resp = _http.get(
             'https://api.nal.usda.gov/fdc/v1/foods/search',
             params={
                 'query': query,
-                'pageSize': 15,
+                'pageSize': page_size,
                 'dataType': 'Foundation,SR Legacy,Survey (FNDDS),Branded',
                 'api_key': USDA_API_KEY,
             },
             timeout=8,
         )
+        if resp.status_code == 429:
+            _usda_cooldown.trip(resp.headers.get('Retry-After'))
         if resp.status_code != 200:
             return []
 
@@ -139,7 +200,14 @@ def search_usda(query: str) -> list[dict]:
             name = food.get('description', '')
             if not name or len(name) > 100:
                 continue
-            nutrients = {n['nutrientName']: n['value'] for n in food.get('foodNutrients', [])}
+            nutrients = {}
+            for n in food.get('foodNutrients', []):
+                nutrient_name = n.get('nutrientName')
+                field = USDA_NUTRIENTS.get(nutrient_name)
+                if field is not None:
+                    nutrients[field] = n.get('value')
+                elif nutrient_name == USDA_SUGAR_FALLBACK:
+                    nutrients.setdefault('sugar', n.get('value'))
             data_type = food.get('dataType', '')
             brand = food.get('brandOwner', '') or food.get('brandName', '')
 
@@ -156,17 +224,38 @@ def search_usda(query: str) -> list[dict]:
                 'barcode': food.get('gtinUpc', ''),
                 'image': '',
                 'serving_size': '100g',
-                'calories': nutrients.get('Energy', 0) or 0,
-                'protein': nutrients.get('Protein', 0) or 0,
-                'carbs': nutrients.get('Carbohydrate, by difference', 0) or 0,
-                'fat': nutrients.get('Total lipid (fat)', 0) or 0,
-                'fiber': nutrients.get('Fiber, total dietary', 0) or 0,
-                'sugar': nutrients.get('Sugars, total including NLEA',
-                                      nutrients.get('Sugars, total', 0)) or 0,
-                'sodium': nutrients.get('Sodium, Na', 0) or 0,
+                'calories': nutrients.get('calories') or 0,
+                'protein': nutrients.get('protein') or 0,
+                'carbs': nutrients.get('carbs') or 0,
+                'fat': nutrients.get('fat') or 0,
+                'fiber': nutrients.get('fiber') or 0,
+                'sugar': nutrients.get('sugar') or 0,
+                'sodium': nutrients.get('sodium') or 0,
                 '_source': 'usda',
             })
         return results
     except Exception as e:
         print(f"USDA search error: {e}")
         return []
+
+
+def search_foods(query: str) -> list[dict]:
+    """Try the configured providers in priority order (FatSecret, then USDA).
+
+    Everything runs on the calling thread and a fallback is only called once
+    the provider above it comes back empty, so a hit never spends USDA quota.
+    A failing provider counts as empty instead of failing the search.
+    """
+    providers = [search_usda]
+    if FATSECRET_CLIENT_ID and FATSECRET_CLIENT_SECRET:
+        providers.insert(0, search_fatsecret)
+
+    for provider in providers:
+        try:
+            products = provider(query)
+        except Exception as e:
+            print(f"Food provider error: {e}")
+            continue
+        if products:
+            return products
+    return []
@@ -1,11 +1,27 @@
 import os
+import heapq
+import hashlib
+import math
+import json
+import sqlite3
+import threading
+import orjson
 import requests
 from dotenv import load_dotenv
-from flask import Flask, redirect, url_for, render_template, request, session, flash, jsonify
+from flask import Flask, redirect, url_for, render_template, request, session, flash, jsonify, g, make_response
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+from jinja2 import FileSystemBytecodeCache
 from datetime import timedelta, datetime, date
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event, func, insert, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import DeclarativeBase, load_only, raiseload
+from collections import defaultdict, namedtuple
 from functools import wraps
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from supabase import create_client, Client
 
 load_dotenv()
@@ -15,11 +31,45 @@ class Base(DeclarativeBase):
     pass
 
 
+class OrjsonProvider(JSONProvider):
+    """Serve jsonify() and request.get_json() through orjson's C encoder."""
+
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=DefaultJSONProvider.default, option=self.option)
+        return self._app.response_class(body, mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Add min/max to Jinja2 templates
 app.jinja_env.globals.update(min=min, max=max)
 
+# Persist compiled templates so a fresh process skips recompiling them.
+# Jinja's default directory is a per-user 0700 dir under the temp dir (the
+# only writable path on Vercel), and it refuses one owned by someone else.
+try:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+except (OSError, RuntimeError):
+    pass
+
+# Load every template up front on long-running servers, so the first hit on
+# each page (and on the error pages) doesn't pay for compiling it. Each
+# gunicorn worker imports the app, and so preloads, on its own. Serverless
+# cold starts only render one page, so they keep loading lazily.
+if not os.environ.get('VERCEL'):
+    for _template in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(_template)
+
 # Configuration - Use environment variables in production
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.permanent_session_lifetime = timedelta(days=5)
@@ -36,6 +86,28 @@ if database_url and database_url.startswith('postgres://'):
 
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not database_url.startswith('sqlite'):
+    # Keep warm Postgres connections around, and drop ones the server closed
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 3600,
+    }
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL + relaxed fsync and a larger in-memory page cache for local SQLite."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
 # Supabase client — lazy so missing env vars don't crash startup
 _supabase_client: Client | None = None
@@ -62,8 +134,13 @@ def init_db():
     """Create tables and handle schema migrations."""
     try:
         with app.app_context():
-            # Create all tables that don't exist
-            db.create_all()
+            # create_all() reflects every table one by one; a single
+            # table-name query is enough to know if there is anything to
+            # create. The backfills below still inspect users and food_logs
+            # on every boot.
+            existing_tables = set(db.inspect(db.engine).get_table_names())
+            if not existing_tables.issuperset(db.metadata.tables):
+                db.create_all()
 
             # Migrate existing tables (add missing columns)
             with db.engine.begin() as conn:
@@ -86,12 +163,70 @@ def init_db():
                 except Exception:
                     # Column might already exist - that's OK
                     pass
+
+                # Add generated per-entry total columns. SQLite can only add
+                # VIRTUAL generated columns to an existing table.
+                try:
+                    existing_cols = [col['name'] for col in inspector.get_columns('food_logs')]
+                    for col in FoodLog.__table__.columns:
+                        if col.computed is None or col.name in existing_cols:
+                            continue
+                        if is_sqlite:
+                            conn.exec_driver_sql(
+                                f'ALTER TABLE food_logs ADD COLUMN {col.name} FLOAT '
+                                f'GENERATED ALWAYS AS ({col.computed.sqltext}) VIRTUAL'
+                            )
+                        else:
+                            conn.exec_driver_sql(
+                                f'ALTER TABLE food_logs ADD COLUMN IF NOT EXISTS {col.name} FLOAT '
+                                f'GENERATED ALWAYS AS ({col.computed.sqltext}) STORED'
+                            )
+                except Exception:
+                    pass
+
+            # create_all() skips indexes on tables that already exist, so
+            # backfill any missing ones. Postgres builds them CONCURRENTLY to
+            # avoid locking food_logs, which can't run inside a transaction.
+            existing_indexes = {ix['name'] for ix in inspector.get_indexes('food_logs')}
+            quote = db.engine.dialect.identifier_preparer.quote
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                created_index = False
+                for index in FoodLog.__table__.indexes:
+                    if index.name in existing_indexes:
+                        continue
+                    columns = ', '.join(quote(col.name) for col in index.columns)
+                    concurrently = '' if is_sqlite else 'CONCURRENTLY '
+                    conn.exec_driver_sql(
+                        f'CREATE INDEX {concurrently}IF NOT EXISTS {index.name} '
+                        f'ON food_logs ({columns})'
+                    )
+                    created_index = True
+
+                # SQLite has no autovacuum/autoanalyze; refresh planner stats
+                # so it actually picks up the new indexes
+                if created_index and is_sqlite:
+                    conn.exec_driver_sql('ANALYZE')
     except Exception:
         # Database connection failed at startup - that's OK for serverless
         # The app will still start, and database operations will fail gracefully
         pass
 
 
+# ============== NUTRITION MATH ==============
+
+# Revised Harris-Benedict coefficients: (constant, per kg, per cm, per year)
+_BMR_COEF = {
+    'male': (88.362, 13.397, 4.799, -5.677),
+    'female': (447.593, 9.247, 3.098, -4.330),
+}
+
+
+def estimate_bmr(gender, weight, height, age):
+    """Revised Harris-Benedict BMR (kcal/day) from kg, cm and years."""
+    a, b, c, d = _BMR_COEF.get(gender, _BMR_COEF['female'])
+    return a + b * weight + c * height + d * age
+
+
 # ============== DATABASE MODELS ==============
 
 class User(db.Model):
@@ -111,8 +246,11 @@ class User(db.Model):
     activity_level = db.Column(db.Float, default=1.2)
     calorie_goal = db.Column(db.Integer, nullable=True)
 
-    # Relationships
-    food_logs = db.relationship('FoodLog', backref='user', lazy=True, cascade='all, delete-orphan')
+    # Relationships. In debug mode lazy loads raise, so an accidental N+1
+    # (e.g. touching user.food_logs in a template) fails loudly.
+    food_logs = db.relationship('FoodLog', back_populates='user',
+                                lazy='raise' if app.debug else 'select',
+                                cascade='all, delete-orphan')
 
     def __init__(self, username, email, supabase_id):
         self.username = username
@@ -122,10 +260,7 @@ class User(db.Model):
     def calculate_bmr(self):
         if not all([self.weight, self.height, self.age, self.gender]):
             return None
-        if self.gender == 'male':
-            return 88.362 + (13.397 * self.weight) + (4.799 * self.height) - (5.677 * self.age)
-        else:
-            return 447.593 + (9.247 * self.weight) + (3.098 * self.height) - (4.330 * self.age)
+        return estimate_bmr(self.gender, self.weight, self.height, self.age)
     
     def calculate_tdee(self):
         bmr = self.calculate_bmr()
@@ -134,12 +269,21 @@ class User(db.Model):
         return None
 
 
+# Diary meals in display order; anything else is stored as a snack
+MEAL_TYPES = ('breakfast', 'lunch', 'dinner', 'snack')
+
+
 class FoodLog(db.Model):
     __tablename__ = 'food_logs'
+    __table_args__ = (
+        # Matches the diary query: filter on (user_id, date), order by created_at
+        db.Index('ix_foodlog_user_date_created', 'user_id', 'date', 'created_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, default=date.today, nullable=False)
-    meal_type = db.Column(db.String(20), default='snack')  # breakfast, lunch, dinner, snack
+    meal_type = db.Column(db.String(20), default='snack')  # one of MEAL_TYPES
     
     # Food info
     food_name = db.Column(db.String(200), nullable=False)
@@ -157,8 +301,18 @@ class FoodLog(db.Model):
     sugar = db.Column(db.Float, default=0)    # grams
     sodium = db.Column(db.Float, default=0)   # mg
     
+    # Totals for the logged amount (nutrient * serving_size), kept by the DB
+    total_calories = db.Column(db.Float, db.Computed('calories * serving_size', persisted=True))
+    total_protein = db.Column(db.Float, db.Computed('protein * serving_size', persisted=True))
+    total_carbs = db.Column(db.Float, db.Computed('carbs * serving_size', persisted=True))
+    total_fat = db.Column(db.Float, db.Computed('fat * serving_size', persisted=True))
+    total_fiber = db.Column(db.Float, db.Computed('fiber * serving_size', persisted=True))
+    
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    user = db.relationship('User', back_populates='food_logs',
+                           lazy='raise' if app.debug else 'select')
+
 
 class CommonFood(db.Model):
     __tablename__ = 'common_foods'
@@ -188,43 +342,157 @@ class FoodCache(db.Model):
 init_db()
 
 
-# Create all tables after models are defined
-# Only create tables if not in Vercel serverless environment
-# (Tables should be created via migrations or manually on Vercel Postgres)
-if not os.environ.get('VERCEL'):
-    with app.app_context():
-        try:
-            db.create_all()
-        except Exception as e:
-            # Silently fail in serverless - tables should exist already
-            pass
-
-
 # ============== DECORATORS ==============
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if "user_id" not in session:
-            flash("Please log in to access this page.", "warning")
-            return redirect(url_for("login"))
-        # Verify user still exists
-        user = get_current_user()
-        if user is None:
-            flash("Please log in again.", "warning")
+        if g.user is None:
+            if g.stale_session:
+                flash("Please log in again.", "warning")
+            else:
+                flash("Please log in to access this page.", "warning")
             return redirect(url_for("login"))
         return f(*args, **kwargs)
     return decorated_function
 
 
-def get_current_user():
-    if "user_id" in session:
-        user = db.session.get(User, session["user_id"])
-        if user is None:
+@app.before_request
+def load_current_user():
+    """Load the session user once per request into g.user."""
+    g.user = None
+    g.stale_session = False
+    user_id = session.get("user_id")
+    if user_id is not None and request.endpoint != "static":
+        # Views only read the profile columns below; the legacy password,
+        # supabase_id and created_at are never needed per request. Any
+        # relationship access is a hidden query, so make it raise instead.
+        g.user = db.session.get(User, user_id, options=[
+            load_only(User.username, User.email, User.height, User.weight, User.age,
+                      User.gender, User.activity_level, User.calorie_goal),
+            raiseload('*'),
+        ])
+        if g.user is None:
             # User was deleted, clear session
             session.clear()
-        return user
-    return None
+            g.stale_session = True
+
+
+def get_current_user():
+    """Return the logged-in User, or None."""
+    return g.user
+
+
+# ============== HELPERS ==============
+
+def get_day_log(user_id, day):
+    """Load a day's entries in one query and group them by meal.
+
+    Returns (meals, meal_calories, totals). Entries are lightweight named
+    Rows rather than FoodLog instances, and every total is accumulated in
+    the same pass that buckets them.
+    """
+    rows = db.session.execute(
+        select(
+            FoodLog.id, FoodLog.meal_type, FoodLog.food_name, FoodLog.brand,
+            FoodLog.serving_size, FoodLog.serving_unit,
+            FoodLog.total_calories, FoodLog.total_protein, FoodLog.total_carbs,
+            FoodLog.total_fat, FoodLog.total_fiber,
+        )
+        .where(FoodLog.user_id == user_id, FoodLog.date == day)
+        .order_by(FoodLog.created_at)
+    )
+
+    meals = {meal: [] for meal in MEAL_TYPES}
+    meal_calories = dict.fromkeys(meals, 0)
+    totals = {'calories': 0, 'protein': 0, 'carbs': 0, 'fat': 0, 'fiber': 0}
+    for row in rows:
+        # Rows logged before meal types were normalized may hold anything
+        meal = row.meal_type if row.meal_type in meals else 'snack'
+        calories = row.total_calories or 0
+        meals[meal].append(row)
+        meal_calories[meal] += calories
+        totals['calories'] += calories
+        totals['protein'] += row.total_protein or 0
+        totals['carbs'] += row.total_carbs or 0
+        totals['fat'] += row.total_fat or 0
+        totals['fiber'] += row.total_fiber or 0
+
+    return meals, meal_calories, totals
+
+
+# Identifies the running code: Vercel's commit SHA, else this process's start
+# time. Part of every diary ETag so a deploy that changes the templates never
+# revalidates a page rendered by the previous one.
+DEPLOY_VERSION = os.environ.get('VERCEL_GIT_COMMIT_SHA') or datetime.utcnow().isoformat()
+
+
+def diary_etag(user, day):
+    """ETag for a rendered diary page.
+
+    Built from everything the page shows that can change: the day's entries
+    (via their count and newest created_at), the user's goal and name, and
+    today's date for the navigation buttons. The lookup is one aggregate over
+    the (user_id, date, created_at) index. DEPLOY_VERSION covers changes to
+    the page itself.
+    """
+    last_created, count = db.session.execute(
+        select(func.max(FoodLog.created_at), func.count(FoodLog.id))
+        .where(FoodLog.user_id == user.id, FoodLog.date == day)
+    ).one()
+    state = (f'{DEPLOY_VERSION}|{user.id}|{user.username}|{user.calorie_goal}|{day}|'
+             f'{date.today()}|{last_created}|{count}')
+    return hashlib.blake2b(state.encode(), digest_size=16).hexdigest()
+
+
+def optional_form_value(field, cast):
+    """Read an optional form field once; cast it, or None when blank."""
+    value = request.form.get(field)
+    return cast(value) if value else None
+
+
+# Per-serving nutrient fields accepted by the log endpoints
+LOG_NUTRIENTS = ('calories', 'protein', 'carbs', 'fat', 'fiber', 'sugar', 'sodium')
+
+
+def _payload_text(data, field, default):
+    value = data.get(field)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    return value
+
+
+def _payload_number(data, field, default):
+    value = float(data.get(field, default))
+    # inf/nan would be stored fine but break every later render of the day
+    if not math.isfinite(value):
+        raise ValueError(f'{field} must be a finite number')
+    return value
+
+
+def food_log_row(user_id, data):
+    """Build a food_logs row from a logging payload, for Core inserts.
+
+    Raises ValueError (or TypeError for wrongly typed fields) on a payload
+    that can't be stored, before any database work starts.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    date_str = data.get('date')
+    meal_type = _payload_text(data, 'meal_type', 'snack').lower()
+    return {
+        'user_id': user_id,
+        'date': date.fromisoformat(date_str) if date_str else date.today(),
+        'meal_type': meal_type if meal_type in MEAL_TYPES else 'snack',
+        'food_name': _payload_text(data, 'name', 'Unknown'),
+        'brand': _payload_text(data, 'brand', ''),
+        'barcode': _payload_text(data, 'barcode', ''),
+        'serving_size': _payload_number(data, 'serving_size', 1),
+        'serving_unit': _payload_text(data, 'serving_unit', 'serving'),
+        **{field: _payload_number(data, field, 0) for field in LOG_NUTRIENTS},
+    }
 
 
 # ============== ROUTES ==============
@@ -241,34 +509,18 @@ def dashboard():
     user = get_current_user()
     today = date.today()
     
-    # Get today's food logs
-    today_logs = FoodLog.query.filter_by(user_id=user.id, date=today).all()
-    
-    # Calculate totals
-    totals = {
-        'calories': sum(log.calories * log.serving_size for log in today_logs),
-        'protein': sum(log.protein * log.serving_size for log in today_logs),
-        'carbs': sum(log.carbs * log.serving_size for log in today_logs),
-        'fat': sum(log.fat * log.serving_size for log in today_logs),
-        'fiber': sum(log.fiber * log.serving_size for log in today_logs),
-    }
+    # Get today's food logs, grouped by meal, with totals
+    meals, meal_calories, totals = get_day_log(user.id, today)
     
     # Get user's calorie goal or calculate from TDEE
-    calorie_goal = user.calorie_goal or (user.calculate_tdee() if user.calculate_tdee() else 2000)
-    
-    # Group logs by meal type
-    meals = {
-        'breakfast': [log for log in today_logs if log.meal_type == 'breakfast'],
-        'lunch': [log for log in today_logs if log.meal_type == 'lunch'],
-        'dinner': [log for log in today_logs if log.meal_type == 'dinner'],
-        'snack': [log for log in today_logs if log.meal_type == 'snack'],
-    }
+    calorie_goal = user.calorie_goal or user.calculate_tdee() or 2000
     
     return render_template("dashboard.html", 
                          user=user, 
                          totals=totals, 
                          calorie_goal=calorie_goal,
                          meals=meals,
+                         meal_calories=meal_calories,
                          today=today)
 
 
@@ -279,12 +531,12 @@ def profile():
     
     if request.method == 'POST':
         user.email = request.form.get('email', user.email)
-        user.height = float(request.form.get('height')) if request.form.get('height') else None
-        user.weight = float(request.form.get('weight')) if request.form.get('weight') else None
-        user.age = int(request.form.get('age')) if request.form.get('age') else None
+        user.height = optional_form_value('height', float)
+        user.weight = optional_form_value('weight', float)
+        user.age = optional_form_value('age', int)
         user.gender = request.form.get('gender')
         user.activity_level = float(request.form.get('activity', 1.2))
-        user.calorie_goal = int(request.form.get('calorie_goal')) if request.form.get('calorie_goal') else None
+        user.calorie_goal = optional_form_value('calorie_goal', int)
         
         db.session.commit()
         flash("Profile updated successfully!", "success")
@@ -355,8 +607,16 @@ def register():
             flash("Password must be at least 6 characters.", "error")
             return render_template("register.html")
 
-        if User.query.filter_by(username=username).first():
-            flash("Username already taken.", "error")
+        taken = db.session.execute(
+            select(User.username, User.email)
+            .where(or_(User.username == username, User.email == email))
+            .limit(1)
+        ).first()
+        if taken:
+            if taken.username == username:
+                flash("Username already taken.", "error")
+            else:
+                flash("Email already registered.", "error")
             return render_template("register.html")
 
         try:
@@ -409,11 +669,8 @@ def calculator_results():
         # Calculate BMI
         bmi = 10000 * (weight / (height * height))
         
-        # Calculate BMR (Mifflin-St Jeor)
-        if gender == 'male':
-            bmr = 88.362 + (13.397 * weight) + (4.799 * height) - (5.677 * age)
-        else:
-            bmr = 447.593 + (9.247 * weight) + (3.098 * height) - (4.330 * age)
+        # Calculate BMR
+        bmr = estimate_bmr(gender, weight, height, age)
         
         tdee = bmr * activity_factor
         
@@ -472,105 +729,246 @@ def food_search():
     return render_template("food_search.html", user=user)
 
 
+# Per-instance cache of final search responses, in front of the FoodCache
+# table, so repeat queries on a warm instance skip the DB and the merge.
+_search_cache = TTLCache(maxsize=2048, ttl=600)
+_search_cache_lock = threading.Lock()
+
+# Barcode lookups never change, so they can be kept for a day.
+_barcode_cache = TTLCache(maxsize=10000, ttl=86400)
+_barcode_cache_lock = threading.Lock()
+
+
+def search_response(products):
+    """JSON search response with a content ETag.
+
+    Typing in the search box repeats near-identical queries, so clients that
+    already hold the same result set get an empty 304 instead of the body.
+    """
+    response = jsonify({'products': products})
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response.make_conditional(request)
+
+
+def search_rank(priority, name, query_key):
+    """Sort key for a merged search result (lowercased name); lower is better.
+
+    Common foods lead, then exact name matches, then prefix matches, then
+    shorter names.
+    """
+    return (priority != 0, name != query_key, not name.startswith(query_key), len(name))
+
+
+# CommonFood is seed data that only changes when seed_foods.py runs, so it is
+# loaded once per process and matched in memory. Every 2-10 character slice
+# of name_simple maps straight to its prebuilt product dicts, so typical
+# queries are a single dict lookup. Longer queries go through a trigram index:
+# any query of 3+ characters that occurs in a name shares its first three.
+CommonFoodEntry = namedtuple(
+    'CommonFoodEntry',
+    'key name brand serving_size calories protein carbs fat fiber sugar sodium',
+)
+COMMON_MATCH_MIN, COMMON_MATCH_MAX = 2, 10
+COMMON_MATCH_LIMIT = 10
+_common_food_index = None
+_common_food_lock = threading.Lock()
+
+
+def common_food_product(food):
+    """Search-result dict for a CommonFoodEntry."""
+    return {
+        'name': food.name,
+        'brand': food.brand,
+        'barcode': '',
+        'image': '',
+        'serving_size': food.serving_size,
+        'calories': food.calories,
+        'protein': food.protein,
+        'carbs': food.carbs,
+        'fat': food.fat,
+        'fiber': food.fiber,
+        'sugar': food.sugar,
+        'sodium': food.sodium,
+        '_source': 'common',
+    }
+
+
+def get_common_food_index():
+    """Return (entries, trigrams, matches), loading CommonFood on first use."""
+    global _common_food_index
+    if _common_food_index is None:
+        with _common_food_lock:
+            if _common_food_index is None:
+                foods = CommonFood.query.order_by(CommonFood.id).all()
+                if not foods:
+                    # Not seeded yet; try again on the next search
+                    return [], {}, {}
+                entries = []
+                trigrams = defaultdict(list)
+                matches = defaultdict(list)
+                for i, food in enumerate(foods):
+                    key = food.name_simple.lower()
+                    entry = CommonFoodEntry(
+                        key, food.name, food.brand, food.serving_size,
+                        food.calories, food.protein, food.carbs, food.fat,
+                        food.fiber, food.sugar, food.sodium,
+                    )
+                    entries.append(entry)
+                    for gram in {key[j:j + 3] for j in range(len(key) - 2)}:
+                        trigrams[gram].append(i)
+
+                    product = common_food_product(entry)
+                    slices = {
+                        key[j:j + n]
+                        for n in range(COMMON_MATCH_MIN, COMMON_MATCH_MAX + 1)
+                        for j in range(len(key) - n + 1)
+                    }
+                    for piece in slices:
+                        if len(matches[piece]) < COMMON_MATCH_LIMIT:
+                            matches[piece].append(product)
+                _common_food_index = (entries, dict(trigrams), dict(matches))
+    return _common_food_index
+
+
+def search_common_foods(query_key, limit=COMMON_MATCH_LIMIT):
+    """Common foods whose simple name contains query_key, in seed order.
+
+    Returns copies, since callers consume the internal _source key.
+    """
+    entries, trigrams, matches = get_common_food_index()
+    if COMMON_MATCH_MIN <= len(query_key) <= COMMON_MATCH_MAX and limit <= COMMON_MATCH_LIMIT:
+        return [dict(p) for p in matches.get(query_key, ())[:limit]]
+
+    if len(query_key) >= 3:
+        candidates = trigrams.get(query_key[:3], ())
+    else:
+        candidates = range(len(entries))
+
+    hits = []
+    for i in candidates:
+        food = entries[i]
+        if query_key in food.key:
+            hits.append(common_food_product(food))
+            if len(hits) == limit:
+                break
+    return hits
+
+
+# Expired FoodCache entries are still served, and re-fetched off the request
+# thread so the user never waits on upstream timeouts for a known query.
+FOOD_CACHE_TTL_DAYS = 7
+_refresh_executor = ThreadPoolExecutor(max_workers=2)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def save_food_cache(query_key, products):
+    """Upsert API results into FoodCache, minus internal '_' fields."""
+    clean = [{k: v for k, v in p.items() if not k.startswith('_')}
+             for p in products]
+    entry = FoodCache.query.filter_by(query_key=query_key).first()
+    if entry:
+        entry.results_json = json.dumps(clean)
+        entry.fetched_at = datetime.utcnow()
+    else:
+        db.session.add(FoodCache(
+            query_key=query_key,
+            results_json=json.dumps(clean),
+        ))
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
+
+def schedule_food_cache_refresh(query, query_key):
+    """Re-fetch an expired FoodCache entry in the background, once per key."""
+    with _refreshing_lock:
+        if query_key in _refreshing:
+            return
+        _refreshing.add(query_key)
+    _refresh_executor.submit(_refresh_food_cache, query, query_key)
+
+
+def _refresh_food_cache(query, query_key):
+    from food_apis import search_foods
+
+    try:
+        with app.app_context():
+            products = search_foods(query)
+            if products:
+                save_food_cache(query_key, products)
+                with _search_cache_lock:
+                    _search_cache.pop(query_key, None)
+    except Exception as e:
+        print(f"Food cache refresh error: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(query_key)
+
+
 @app.route("/api/food/search")
 @login_required
 def api_food_search():
     """Local-first search: CommonFood > Cache > FatSecret API > USDA fallback"""
-    from food_apis import search_fatsecret, search_usda
-    import json
+    from food_apis import search_foods
 
     query = request.args.get('q', '').strip()
     if not query:
         return jsonify({'products': []})
 
     query_key = query.lower().strip()
+    with _search_cache_lock:
+        hit = _search_cache.get(query_key)
+    if hit is not None:
+        return search_response(hit)
+
     all_products = []
     cache_miss = True
 
     # Step 1: CommonFood table (instant, no API)
-    common_hits = CommonFood.query.filter(
-        CommonFood.name_simple.ilike(f'%{query_key}%')
-    ).limit(10).all()
-
-    for food in common_hits:
-        all_products.append({
-            'name': food.name,
-            'brand': food.brand,
-            'barcode': '',
-            'image': '',
-            'serving_size': food.serving_size,
-            'calories': food.calories,
-            'protein': food.protein,
-            'carbs': food.carbs,
-            'fat': food.fat,
-            'fiber': food.fiber,
-            'sugar': food.sugar,
-            'sodium': food.sodium,
-            '_source': 'common',
-        })
+    all_products.extend(search_common_foods(query_key))
 
     # Step 2: FoodCache lookup (TTL 7 days)
-    CACHE_TTL_DAYS = 7
     cached = FoodCache.query.filter_by(query_key=query_key).first()
     if cached:
-        age = datetime.utcnow() - cached.fetched_at
-        if age.days < CACHE_TTL_DAYS:
-            cached_products = json.loads(cached.results_json)
-            all_products.extend(cached_products)
-            cache_miss = False
+        all_products.extend(json.loads(cached.results_json))
+        cache_miss = False
+        if (datetime.utcnow() - cached.fetched_at).days >= FOOD_CACHE_TTL_DAYS:
+            # Serve the stale entry now rather than block on the APIs
+            schedule_food_cache_refresh(query, query_key)
 
     # Steps 3 & 4: API calls only on cache miss
     if cache_miss:
-        api_products = []
-
-        # FatSecret (primary — 5000 calls/day free)
-        fs_results = search_fatsecret(query)
-        api_products.extend(fs_results)
-
-        # USDA fallback
-        if not fs_results:
-            usda_results = search_usda(query)
-            api_products.extend(usda_results)
-
-        # Save to cache (upsert pattern)
+        # FatSecret (primary — 5000 calls/day free) with USDA fallback
+        api_products = search_foods(query)
         if api_products:
-            clean = [{k: v for k, v in p.items() if not k.startswith('_')}
-                     for p in api_products]
-            if cached:
-                cached.results_json = json.dumps(clean)
-                cached.fetched_at = datetime.utcnow()
-            else:
-                db.session.add(FoodCache(
-                    query_key=query_key,
-                    results_json=json.dumps(clean),
-                ))
-            try:
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
+            save_food_cache(query_key, api_products)
 
         all_products.extend(api_products)
 
-    # Merge and deduplicate
+    # Merge and deduplicate in one pass, keeping the best source per key.
+    # _source is consumed here so nothing internal reaches the response.
     SOURCE_PRIORITY = {'common': 0, 'fatsecret': 1, 'usda': 2, '': 1}
-    seen = {}
+    best = {}
     for p in all_products:
-        key = (p['name'].lower()[:40], p['brand'].lower()[:20])
-        if key not in seen:
-            seen[key] = p
-        else:
-            existing_priority = SOURCE_PRIORITY.get(seen[key].get('_source', ''), 1)
-            this_priority = SOURCE_PRIORITY.get(p.get('_source', ''), 1)
-            if this_priority < existing_priority:
-                seen[key] = p
+        name = p['name'].lower()
+        key = (name[:40], p['brand'].lower()[:20])
+        priority = SOURCE_PRIORITY.get(p.pop('_source', ''), 1)
+        current = best.get(key)
+        if current is None or priority < current[0]:
+            best[key] = (priority, search_rank(priority, name, query_key), p)
 
-    results = list(seen.values())
-    results.sort(key=lambda p: (0 if p.get('_source') == 'common' else 1, len(p['name'])))
+    # Only the top 25 are returned; no need to sort the full merged list
+    top = heapq.nsmallest(25, best.values(), key=itemgetter(1))
+    results = [p for _, _, p in top]
 
-    for p in results:
-        p.pop('_source', None)
+    if results:
+        with _search_cache_lock:
+            _search_cache[query_key] = results
 
-    return jsonify({'products': results[:25]})
+    return search_response(results)
 
 
 @app.route("/api/food/barcode/<barcode>")
@@ -579,10 +977,19 @@ def api_food_barcode(barcode):
     """Look up food by barcode using USDA FoodData Central API"""
     from food_apis import search_usda
 
+    with _barcode_cache_lock:
+        product = _barcode_cache.get(barcode)
+    if product is not None:
+        return jsonify({'found': True, 'product': product})
+
     try:
-        results = search_usda(barcode)
+        # Only the top hit is used; each USDA food carries its full nutrient
+        # list, so don't download a whole page of them
+        results = search_usda(barcode, page_size=3)
         if results:
             product = results[0]
+            with _barcode_cache_lock:
+                _barcode_cache[barcode] = product
             return jsonify({
                 'found': True,
                 'product': product
@@ -597,50 +1004,70 @@ def api_food_barcode(barcode):
 @login_required
 def api_log_food():
     """Log food to user's diary"""
-    user = get_current_user()
-    data = request.json
-    
+    user_id = session["user_id"]
     try:
-        food_log = FoodLog(
-            user_id=user.id,
-            date=datetime.strptime(data.get('date', str(date.today())), '%Y-%m-%d').date(),
-            meal_type=data.get('meal_type', 'snack'),
-            food_name=data.get('name', 'Unknown'),
-            brand=data.get('brand', ''),
-            barcode=data.get('barcode', ''),
-            serving_size=float(data.get('serving_size', 1)),
-            serving_unit=data.get('serving_unit', 'serving'),
-            calories=float(data.get('calories', 0)),
-            protein=float(data.get('protein', 0)),
-            carbs=float(data.get('carbs', 0)),
-            fat=float(data.get('fat', 0)),
-            fiber=float(data.get('fiber', 0)),
-            sugar=float(data.get('sugar', 0)),
-            sodium=float(data.get('sodium', 0)),
-        )
-        
-        db.session.add(food_log)
+        row = food_log_row(user_id, request.get_json(silent=True))
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'Invalid food data: {e}'}), 400
+
+    try:
+        db.session.execute(insert(FoodLog), [row])
         db.session.commit()
-        
-        return jsonify({'success': True, 'message': 'Food logged successfully!'})
-    
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+    except SQLAlchemyError:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': 'Could not save food log'}), 500
+
+    return jsonify({'success': True, 'message': 'Food logged successfully!'})
+
+
+# One request is one INSERT; keeps a single call from holding a huge payload
+BULK_LOG_MAX_ITEMS = 100
+
+
+@app.route("/api/food/log/bulk", methods=['POST'])
+@app.route("/api/food/log_batch", methods=['POST'])
+@login_required
+def api_log_food_bulk():
+    """Log several foods to user's diary with one multi-row INSERT"""
+    user_id = session["user_id"]
+    items = request.get_json(silent=True)
+    if isinstance(items, dict):
+        items = items.get('items')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Expected a non-empty list of foods'}), 400
+    if len(items) > BULK_LOG_MAX_ITEMS:
+        return jsonify({'success': False,
+                        'error': f'At most {BULK_LOG_MAX_ITEMS} foods per request'}), 400
+
+    try:
+        rows = [food_log_row(user_id, item) for item in items]
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'Invalid food data: {e}'}), 400
+
+    try:
+        db.session.execute(insert(FoodLog), rows)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': 'Could not save food log'}), 500
+
+    return jsonify({'success': True, 'logged': len(rows)})
 
 
 @app.route("/api/food/log/<int:log_id>", methods=['DELETE'])
 @login_required
 def api_delete_food_log(log_id):
     """Delete a food log entry"""
-    user = get_current_user()
-    
-    log = FoodLog.query.filter_by(id=log_id, user_id=user.id).first()
-    
-    if log:
-        db.session.delete(log)
-        db.session.commit()
+    # One DELETE scoped to the owner; the rowcount says whether it existed
+    deleted = FoodLog.query.filter_by(id=log_id, user_id=session["user_id"]).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    if deleted:
         return jsonify({'success': True})
-    
+
     return jsonify({'success': False, 'error': 'Log not found'})
 
 
@@ -657,63 +1084,67 @@ def food_diary():
     user = get_current_user()
     
     # Get date from query param or use today
-    date_str = request.args.get('date', str(date.today()))
+    date_str = request.args.get('date')
     try:
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-    except:
+        selected_date = date.fromisoformat(date_str) if date_str else date.today()
+    except ValueError:
         selected_date = date.today()
     
-    # Get food logs for selected date
-    logs = FoodLog.query.filter_by(user_id=user.id, date=selected_date).order_by(FoodLog.created_at).all()
-    
-    # Calculate totals
-    totals = {
-        'calories': sum(log.calories * log.serving_size for log in logs),
-        'protein': sum(log.protein * log.serving_size for log in logs),
-        'carbs': sum(log.carbs * log.serving_size for log in logs),
-        'fat': sum(log.fat * log.serving_size for log in logs),
-        'fiber': sum(log.fiber * log.serving_size for log in logs),
-    }
-    
-    # Group by meal
-    meals = {
-        'breakfast': [log for log in logs if log.meal_type == 'breakfast'],
-        'lunch': [log for log in logs if log.meal_type == 'lunch'],
-        'dinner': [log for log in logs if log.meal_type == 'dinner'],
-        'snack': [log for log in logs if log.meal_type == 'snack'],
-    }
-    
-    calorie_goal = user.calorie_goal or 2000
-    
-    return render_template("diary.html", 
-                         user=user, 
-                         meals=meals, 
-                         totals=totals,
-                         calorie_goal=calorie_goal,
-                         selected_date=selected_date)
+    # Pending flash messages are rendered into the page, so those responses
+    # are never tagged or answered with a 304
+    etag = None if session.get('_flashes') else diary_etag(user, selected_date)
+    if etag and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        # Get food logs for selected date, grouped by meal, with totals
+        meals, meal_calories, totals = get_day_log(user.id, selected_date)
+
+        calorie_goal = user.calorie_goal or 2000
+
+        response = make_response(render_template("diary.html",
+                                                 user=user,
+                                                 meals=meals,
+                                                 meal_calories=meal_calories,
+                                                 totals=totals,
+                                                 calorie_goal=calorie_goal,
+                                                 selected_date=selected_date))
+    if etag:
+        response.set_etag(etag)
+        # Always revalidate: a fresh log must show up on the next visit
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 # ============== ERROR HANDLERS ==============
 
+# Error pages only vary with the logged-in nav, so each variant is rendered
+# once per process. Pending flashes are part of the page and bypass this.
+_error_pages = {}
+
+
+def render_error_page(template):
+    if session.get('_flashes'):
+        return render_template(template)
+    key = (template, bool(session.get('user_id')))
+    html = _error_pages.get(key)
+    if html is None:
+        html = _error_pages[key] = render_template(template)
+    return html
+
+
 @app.errorhandler(404)
 def not_found(e):
-    return render_template("404.html"), 404
+    return render_error_page("404.html"), 404
 
 
 @app.errorhandler(500)
 def server_error(e):
-    return render_template("500.html"), 500
+    return render_error_page("500.html"), 500
 
 
 # ============== MAIN ==============
 
 if __name__ == "__main__":
-    if not os.environ.get('VERCEL'):
-        with app.app_context():
-            try:
-                db.create_all()
-            except Exception as e:
-                pass
-    # Only run in debug mode for local development
-    # In production, use: gunicorn main:app
+    # Werkzeug dev server, for local development only
+    # In production, use: gunicorn -w 4 -k gthread --threads 8 wsgi:app
     app.run(debug=os.environ.get('FLASK_DEBUG', 'False').lower() == 'true', host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -14,16 +14,21 @@ Run: python -m pytest tests/test_food_api.py -v
 import json
 import os
 import sys
+from datetime import date
+from types import SimpleNamespace
+
 import pytest
 
 # Force a fresh test DB before main.py initializes its own DB at import time
 _TEST_DB = os.path.join(os.path.dirname(__file__), "test.db")
 os.environ.setdefault("DATABASE_URL", f"sqlite:///{_TEST_DB}")
+# Debug mode makes lazy relationship loads raise, catching accidental N+1s
+os.environ.setdefault("FLASK_DEBUG", "true")
 
 # Make sure we can import main from the project root
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from main import app, db, User
+from main import app, db, User, FoodLog, BULK_LOG_MAX_ITEMS
 
 
 # ---------------------------------------------------------------------------
@@ -45,13 +50,16 @@ def test_app():
         db.session.commit()
         yield app
         db.drop_all()
+        db.engine.dispose()
 
-    # Clean up test DB file (best-effort — Windows may hold the lock briefly)
-    try:
-        if os.path.exists(_TEST_DB):
-            os.remove(_TEST_DB)
-    except PermissionError:
-        pass
+    # Clean up test DB files, including SQLite's WAL sidecars (best-effort —
+    # Windows may hold the lock briefly)
+    for path in (_TEST_DB, _TEST_DB + "-wal", _TEST_DB + "-shm"):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except PermissionError:
+            pass
 
 
 @pytest.fixture
@@ -91,6 +99,18 @@ class TestAuthProtection:
         r = client.delete("/api/food/log/1")
         assert r.status_code in (302, 401), "delete log must require login"
 
+    def test_bulk_log_requires_login(self, client):
+        r = client.post("/api/food/log/bulk", json=[{"name": "Oreo"}])
+        assert r.status_code in (302, 401), "bulk log endpoint must require login"
+
+    def test_deleted_user_session_is_cleared(self, client):
+        with client.session_transaction() as sess:
+            sess["user_id"] = 999999
+        r = client.get("/")
+        assert b"Logout" not in r.data
+        with client.session_transaction() as sess:
+            assert "user_id" not in sess
+
 
 # ---------------------------------------------------------------------------
 # FOOD SEARCH ENDPOINT  /api/food/search?q=...
@@ -221,6 +241,13 @@ class TestEdgeCases:
         r = logged_in_client.get(f"/api/food/barcode/{payload}")
         assert r.status_code in (200, 400, 404)
 
+    def test_404_page_keeps_nav_for_login_state(self, test_app, logged_in_client):
+        anon = test_app.test_client().get("/no-such-page")
+        member = logged_in_client.get("/no-such-page")
+        assert anon.status_code == member.status_code == 404
+        assert b"Get Started" in anon.data
+        assert b"Logout" in member.data
+
 
 # ---------------------------------------------------------------------------
 # FOOD LOG ENDPOINT  POST /api/food/log
@@ -268,10 +295,26 @@ class TestFoodLog:
     def test_string_calories_handled(self, logged_in_client):
         payload = {**self.BASE_PAYLOAD, "calories": "not-a-number"}
         r = logged_in_client.post("/api/food/log", json=payload)
-        # Should either succeed with 0 or return error — must not 500
-        assert r.status_code == 200
-        data = r.get_json()
-        assert "success" in data
+        # Rejected up front as a client error — must not 500
+        assert r.status_code == 400
+        assert r.get_json()["success"] is False
+
+    @pytest.mark.parametrize("override", [
+        {"name": {"a": 1}}, {"name": ["x"]}, {"brand": {"a": 1}},
+        {"serving_unit": [1]}, {"meal_type": ["lunch"]}, {"barcode": 123},
+    ])
+    def test_non_string_text_field_rejected(self, logged_in_client, override):
+        r = logged_in_client.post("/api/food/log", json={**self.BASE_PAYLOAD, **override})
+        assert r.status_code == 400
+        assert r.get_json()["success"] is False
+
+    @pytest.mark.parametrize("override", [
+        {"calories": "inf"}, {"protein": "nan"}, {"serving_size": "-inf"},
+    ])
+    def test_non_finite_number_rejected(self, logged_in_client, override):
+        r = logged_in_client.post("/api/food/log", json={**self.BASE_PAYLOAD, **override})
+        assert r.status_code == 400
+        assert r.get_json()["success"] is False
 
     def test_zero_serving_size(self, logged_in_client):
         payload = {**self.BASE_PAYLOAD, "serving_size": 0}
@@ -311,6 +354,55 @@ class TestFoodLog:
             assert r.status_code == 200, f"meal_type={meal} failed"
 
 
+# ---------------------------------------------------------------------------
+# BULK FOOD LOG ENDPOINT  POST /api/food/log/bulk
+# ---------------------------------------------------------------------------
+
+class TestBulkFoodLog:
+    def test_logs_every_item(self, logged_in_client):
+        items = [
+            {**TestFoodLog.BASE_PAYLOAD, "name": "Bulk Item A", "date": "2002-03-04"},
+            {**TestFoodLog.BASE_PAYLOAD, "name": "Bulk Item B", "date": "2002-03-04"},
+        ]
+        r = logged_in_client.post("/api/food/log/bulk", json=items)
+        assert r.status_code == 200
+        assert r.get_json() == {"success": True, "logged": 2}
+
+        with app.app_context():
+            names = {log.food_name for log in FoodLog.query.filter_by(date=date(2002, 3, 4))}
+        assert names == {"Bulk Item A", "Bulk Item B"}
+
+    def test_log_batch_accepts_items_envelope(self, logged_in_client):
+        items = [{**TestFoodLog.BASE_PAYLOAD, "name": "Batch Item", "date": "2002-03-06"}]
+        r = logged_in_client.post("/api/food/log_batch", json={"items": items})
+        assert r.get_json() == {"success": True, "logged": 1}
+
+    @pytest.mark.parametrize("body", [[], {"items": []}, {"name": "Oreo"}, "oreo", ["oreo"]])
+    def test_rejects_non_list_body(self, logged_in_client, body):
+        r = logged_in_client.post("/api/food/log/bulk", json=body)
+        assert r.status_code == 400
+        assert r.get_json()["success"] is False
+
+    def test_rejects_oversized_batch(self, logged_in_client):
+        items = [{**TestFoodLog.BASE_PAYLOAD, "name": "Too Many", "date": "2002-03-07"}]
+        r = logged_in_client.post("/api/food/log/bulk", json=items * (BULK_LOG_MAX_ITEMS + 1))
+        assert r.status_code == 400
+
+        with app.app_context():
+            assert FoodLog.query.filter_by(food_name="Too Many").count() == 0
+
+    def test_bad_item_logs_nothing(self, logged_in_client):
+        items = [
+            {**TestFoodLog.BASE_PAYLOAD, "name": "Never Stored", "date": "2002-03-05"},
+            {**TestFoodLog.BASE_PAYLOAD, "calories": "lots", "date": "2002-03-05"},
+        ]
+        r = logged_in_client.post("/api/food/log/bulk", json=items)
+        assert r.get_json()["success"] is False
+
+        with app.app_context():
+            assert FoodLog.query.filter_by(food_name="Never Stored").count() == 0
+
+
 # ---------------------------------------------------------------------------
 # DELETE LOG ENDPOINT  DELETE /api/food/log/<id>
 # ---------------------------------------------------------------------------
@@ -363,6 +455,21 @@ class TestBarcodeEndpoint:
         data = r.get_json()
         assert data["found"] is False
 
+    def test_found_barcode_is_cached(self, logged_in_client, monkeypatch):
+        import food_apis
+        calls = []
+
+        def fake_usda(query, page_size=15):
+            calls.append(query)
+            return [{"name": "Cached Bar", "calories": 200}]
+
+        monkeypatch.setattr(food_apis, "search_usda", fake_usda)
+        for _ in range(2):
+            data = logged_in_client.get("/api/food/barcode/111122223333").get_json()
+            assert data["found"] is True
+            assert data["product"]["name"] == "Cached Bar"
+        assert calls == ["111122223333"]
+
     @pytest.mark.live
     def test_oreo_barcode_lookup(self, logged_in_client):
         # Oreo original barcode
@@ -373,3 +480,451 @@ class TestBarcodeEndpoint:
             product = data["product"]
             assert product["calories"] > 0
             assert "name" in product
+
+
+# ---------------------------------------------------------------------------
+# DASHBOARD / DIARY  GET /dashboard, GET /diary?date=...
+# ---------------------------------------------------------------------------
+
+class TestDiaryTotals:
+    # Each scenario logs to its own day so the tests don't see each other's rows
+    TOTALS_DAY = "2001-02-03"
+    SNACKS_DAY = "2001-02-04"
+    ETAG_DAY = "2001-02-05"
+    NORMALIZED_DAY = "2001-02-06"
+
+    def _log(self, client, day, **overrides):
+        payload = {
+            "name": "Test Food", "brand": "", "barcode": "",
+            "serving_size": 1, "serving_unit": "serving", "meal_type": "lunch",
+            "calories": 100, "protein": 10, "carbs": 20, "fat": 5,
+            "fiber": 2, "sugar": 1, "sodium": 10, "date": day,
+        }
+        payload.update(overrides)
+        r = client.post("/api/food/log", json=payload)
+        assert r.get_json()["success"] is True
+
+    def test_dashboard_renders(self, logged_in_client):
+        r = logged_in_client.get("/dashboard")
+        assert r.status_code == 200
+
+    def test_empty_day_has_zero_totals(self, logged_in_client):
+        r = logged_in_client.get("/diary?date=1999-01-01")
+        assert r.status_code == 200
+        assert b'class="text-gold">0</div>' in r.data
+
+    def test_totals_scale_by_serving_size(self, logged_in_client):
+        self._log(logged_in_client, self.TOTALS_DAY, calories=100, serving_size=2)
+        self._log(logged_in_client, self.TOTALS_DAY, calories=50, meal_type="dinner")
+        r = logged_in_client.get(f"/diary?date={self.TOTALS_DAY}")
+        assert r.status_code == 200
+        assert b'class="text-gold">250</div>' in r.data
+        assert b'class="meal-calories">200 kcal</span>' in r.data
+        assert b'class="meal-calories">50 kcal</span>' in r.data
+
+    def test_unknown_meal_type_shown_with_snacks(self, logged_in_client):
+        self._log(logged_in_client, self.SNACKS_DAY, meal_type="brunch", calories=70)
+        r = logged_in_client.get(f"/diary?date={self.SNACKS_DAY}")
+        assert r.status_code == 200
+        assert r.data.count(b'class="meal-section"') == 4
+        assert b'class="meal-calories">70 kcal</span>' in r.data
+
+    def test_meal_type_normalized_on_write(self, test_app, logged_in_client):
+        self._log(logged_in_client, self.NORMALIZED_DAY, meal_type="Dinner")
+        self._log(logged_in_client, self.NORMALIZED_DAY, meal_type="brunch")
+        day = date.fromisoformat(self.NORMALIZED_DAY)
+        with test_app.app_context():
+            stored = {row.meal_type for row in FoodLog.query.filter_by(date=day)}
+        assert stored == {"dinner", "snack"}
+
+    def test_unchanged_diary_returns_not_modified(self, logged_in_client):
+        self._log(logged_in_client, self.ETAG_DAY, calories=80)
+        first = logged_in_client.get(f"/diary?date={self.ETAG_DAY}")
+        etag = first.headers["ETag"]
+
+        again = logged_in_client.get(f"/diary?date={self.ETAG_DAY}", headers={"If-None-Match": etag})
+        assert again.status_code == 304
+        assert again.data == b""
+
+        # A new entry changes the ETag, so the page is rendered again
+        self._log(logged_in_client, self.ETAG_DAY, calories=20)
+        changed = logged_in_client.get(f"/diary?date={self.ETAG_DAY}", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert b'class="text-gold">100</div>' in changed.data
+
+    def test_new_deploy_changes_diary_etag(self, logged_in_client, monkeypatch):
+        import main
+        etag = logged_in_client.get(f"/diary?date={self.ETAG_DAY}").headers["ETag"]
+        monkeypatch.setattr(main, "DEPLOY_VERSION", "next-deploy")
+        r = logged_in_client.get(f"/diary?date={self.ETAG_DAY}", headers={"If-None-Match": etag})
+        assert r.status_code == 200
+
+    def test_invalid_date_falls_back_to_today(self, logged_in_client):
+        r = logged_in_client.get("/diary?date=not-a-date")
+        assert r.status_code == 200
+
+
+# ---------------------------------------------------------------------------
+# PROVIDER FALLBACK  food_apis.search_foods
+# ---------------------------------------------------------------------------
+
+class TestSearchFoods:
+    @pytest.fixture
+    def providers(self, monkeypatch):
+        import food_apis
+        monkeypatch.setattr(food_apis, "FATSECRET_CLIENT_ID", "id")
+        monkeypatch.setattr(food_apis, "FATSECRET_CLIENT_SECRET", "secret")
+        monkeypatch.setattr(food_apis, "search_usda", lambda q: [{"name": "usda"}])
+        return food_apis
+
+    def test_fatsecret_results_win(self, providers, monkeypatch):
+        monkeypatch.setattr(providers, "search_fatsecret", lambda q: [{"name": "fs"}])
+        assert providers.search_foods("apple") == [{"name": "fs"}]
+
+    def test_usda_used_when_fatsecret_empty(self, providers, monkeypatch):
+        monkeypatch.setattr(providers, "search_fatsecret", lambda q: [])
+        assert providers.search_foods("apple") == [{"name": "usda"}]
+
+    def test_failing_provider_does_not_fail_search(self, providers, monkeypatch):
+        def boom(q):
+            raise RuntimeError("provider down")
+        monkeypatch.setattr(providers, "search_fatsecret", boom)
+        assert providers.search_foods("apple") == [{"name": "usda"}]
+
+    def test_fallback_not_called_when_primary_answers(self, providers, monkeypatch):
+        calls = []
+
+        def usda(q):
+            calls.append(q)
+            return [{"name": "usda"}]
+        monkeypatch.setattr(providers, "search_usda", usda)
+        monkeypatch.setattr(providers, "search_fatsecret", lambda q: [{"name": "fs"}])
+        assert providers.search_foods("apple") == [{"name": "fs"}]
+        assert calls == []
+
+
+# ---------------------------------------------------------------------------
+# SEARCH CACHE  in-process TTL cache in front of FoodCache
+# ---------------------------------------------------------------------------
+
+class TestSearchCache:
+    PRODUCT = {
+        "name": "Cachefruit", "brand": "Generic", "barcode": "", "image": "",
+        "serving_size": "100g", "calories": 50, "protein": 1, "carbs": 12,
+        "fat": 0, "fiber": 2, "sugar": 9, "sodium": 1, "_source": "usda",
+    }
+
+    def test_repeat_query_served_from_memory(self, logged_in_client, monkeypatch):
+        import food_apis
+        import main
+        calls = []
+
+        def fake_search(query):
+            calls.append(query)
+            return [dict(self.PRODUCT)]
+
+        monkeypatch.setattr(food_apis, "search_foods", fake_search)
+        first = logged_in_client.get("/api/food/search?q=Cachefruit").get_json()
+        # Drop the DB-level cache so only the in-process cache can answer
+        with main.app.app_context():
+            main.FoodCache.query.filter_by(query_key="cachefruit").delete()
+            main.db.session.commit()
+        second = logged_in_client.get("/api/food/search?q=  cachefruit ").get_json()
+
+        assert calls == ["Cachefruit"]
+        assert first == second
+        assert first["products"][0]["name"] == "Cachefruit"
+
+    def test_stale_db_entry_served_then_refreshed(self, logged_in_client, monkeypatch):
+        import time
+        from datetime import datetime, timedelta
+        import food_apis
+        import main
+
+        stale = {**self.PRODUCT, "name": "Stalefruit"}
+        stale.pop("_source")
+        with main.app.app_context():
+            main.db.session.add(main.FoodCache(
+                query_key="stalefruit",
+                results_json=json.dumps([stale]),
+                fetched_at=datetime.utcnow() - timedelta(days=30),
+            ))
+            main.db.session.commit()
+
+        fresh = {**self.PRODUCT, "name": "Stalefruit", "calories": 99}
+        monkeypatch.setattr(food_apis, "search_foods", lambda q: [dict(fresh)])
+
+        r = logged_in_client.get("/api/food/search?q=stalefruit")
+        assert r.get_json()["products"][0]["calories"] == 50
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            with main.app.app_context():
+                entry = main.FoodCache.query.filter_by(query_key="stalefruit").first()
+                main.db.session.refresh(entry)
+                if json.loads(entry.results_json)[0]["calories"] == 99:
+                    break
+            time.sleep(0.05)
+        else:
+            pytest.fail("stale FoodCache entry was not refreshed")
+
+    def test_etag_returns_not_modified(self, logged_in_client, monkeypatch):
+        import food_apis
+        product = {**self.PRODUCT, "name": "Etagfruit"}
+        monkeypatch.setattr(food_apis, "search_foods", lambda q: [dict(product)])
+
+        first = logged_in_client.get("/api/food/search?q=etagfruit")
+        etag = first.headers["ETag"]
+        assert first.status_code == 200
+        assert "private" in first.headers["Cache-Control"]
+
+        second = logged_in_client.get(
+            "/api/food/search?q=etagfruit", headers={"If-None-Match": etag}
+        )
+        assert second.status_code == 304
+        assert second.data == b""
+
+    def test_prefix_match_ranks_before_substring(self, logged_in_client, monkeypatch):
+        import food_apis
+        products = [
+            {**self.PRODUCT, "name": "Pinerankfruit"},
+            {**self.PRODUCT, "name": "Rankfruit, dried"},
+            {**self.PRODUCT, "name": "Rankfruit"},
+        ]
+        monkeypatch.setattr(food_apis, "search_foods", lambda q: [dict(p) for p in products])
+
+        names = [p["name"] for p in
+                 logged_in_client.get("/api/food/search?q=rankfruit").get_json()["products"]]
+        assert names == ["Rankfruit", "Rankfruit, dried", "Pinerankfruit"]
+
+
+class TestUsdaParsing:
+    class FakeResponse:
+        status_code = 200
+
+        def __init__(self, payload, headers=None):
+            self._payload = payload
+            self.headers = headers or {}
+
+        def json(self):
+            return self._payload
+
+    @pytest.fixture(autouse=True)
+    def fresh_cooldown(self, monkeypatch):
+        import food_apis
+        monkeypatch.setattr(food_apis, "_usda_cooldown", food_apis.Cooldown(default=3600))
+
+    def _search(self, monkeypatch, nutrients):
+        import food_apis
+        payload = {"foods": [{
+            "description": "Apple, raw",
+            "dataType": "Foundation",
+            "foodNutrients": nutrients,
+        }]}
+        monkeypatch.setattr(food_apis._http, "get",
+                            lambda *a, **kw: self.FakeResponse(payload))
+        return food_apis.search_usda("apple")[0]
+
+    def test_maps_wanted_nutrients(self, monkeypatch):
+        product = self._search(monkeypatch, [
+            {"nutrientName": "Energy", "value": 52},
+            {"nutrientName": "Protein", "value": 0.3},
+            {"nutrientName": "Total lipid (fat)", "value": 0.2},
+            {"nutrientName": "Vitamin C, total ascorbic acid", "value": 4.6},
+        ])
+        assert product["calories"] == 52
+        assert product["protein"] == 0.3
+        assert product["fat"] == 0.2
+        assert product["carbs"] == 0
+        assert product["brand"] == "Generic"
+
+    def test_nlea_sugar_preferred_over_plain_total(self, monkeypatch):
+        product = self._search(monkeypatch, [
+            {"nutrientName": "Sugars, total including NLEA", "value": 10.4},
+            {"nutrientName": "Sugars, total", "value": 9.0},
+        ])
+        assert product["sugar"] == 10.4
+
+    def test_plain_sugar_total_fallback(self, monkeypatch):
+        product = self._search(monkeypatch, [
+            {"nutrientName": "Sugars, total", "value": 9.0},
+        ])
+        assert product["sugar"] == 9.0
+
+    def test_burst_is_not_throttled_locally(self, monkeypatch):
+        import food_apis
+        calls = []
+
+        def fake_get(*a, **kw):
+            calls.append(1)
+            return self.FakeResponse({"foods": []})
+
+        monkeypatch.setattr(food_apis._http, "get", fake_get)
+        for _ in range(50):
+            food_apis.search_usda("apple")
+        assert len(calls) == 50
+
+    def test_cooldown_after_429(self, monkeypatch):
+        import food_apis
+        calls = []
+
+        def fake_get(*a, **kw):
+            calls.append(1)
+            return self.FakeResponse({}, headers={"Retry-After": "120"})
+
+        now = 1000.0
+        monkeypatch.setattr(food_apis, "time", SimpleNamespace(monotonic=lambda: now))
+        monkeypatch.setattr(self.FakeResponse, "status_code", 429)
+        monkeypatch.setattr(food_apis._http, "get", fake_get)
+        assert food_apis.search_usda("apple") == []
+        # Skipped until Retry-After has passed, then tried again
+        now += 119
+        assert food_apis.search_usda("apple") == []
+        assert len(calls) == 1
+        now += 2
+        food_apis.search_usda("apple")
+        assert len(calls) == 2
+
+
+# ---------------------------------------------------------------------------
+# CALCULATOR  POST /calculator/results
+# ---------------------------------------------------------------------------
+
+class TestCalculator:
+    FORM = {"height": "175", "weight": "70", "age": "25", "activity": "1.2"}
+
+    @pytest.mark.parametrize("gender,bmr", [("male", 1724), ("female", 1529)])
+    def test_bmr_by_gender(self, client, gender, bmr):
+        r = client.post("/calculator/results", data={**self.FORM, "gender": gender})
+        assert r.status_code == 200
+        assert f'stat-value-purple">{bmr}</div>'.encode() in r.data
+
+    def test_invalid_input_redirects(self, client):
+        r = client.post("/calculator/results", data={**self.FORM, "height": "tall", "gender": "male"})
+        assert r.status_code == 302
+
+
+
+# ---------------------------------------------------------------------------
+# PROFILE  POST /profile
+# ---------------------------------------------------------------------------
+
+class TestProfile:
+    def _user(self):
+        with app.app_context():
+            return User.query.filter_by(username="testuser").first()
+
+    def test_updates_stats(self, logged_in_client):
+        r = logged_in_client.post("/profile", data={
+            "email": "test@test.com", "height": "180", "weight": "75.5",
+            "age": "30", "gender": "male", "activity": "1.55", "calorie_goal": "",
+        })
+        assert r.status_code == 302
+        user = self._user()
+        assert (user.height, user.weight, user.age) == (180.0, 75.5, 30)
+        assert user.calorie_goal is None
+
+    def test_blank_fields_clear_stats(self, logged_in_client):
+        r = logged_in_client.post("/profile", data={
+            "email": "test@test.com", "height": "", "weight": "", "age": "",
+            "gender": "", "activity": "1.2", "calorie_goal": "2200",
+        })
+        assert r.status_code == 302
+        user = self._user()
+        assert (user.height, user.weight, user.age) == (None, None, None)
+        assert user.calorie_goal == 2200
+
+
+# ---------------------------------------------------------------------------
+# REGISTER  POST /register  (duplicate checks run before Supabase sign-up)
+# ---------------------------------------------------------------------------
+
+class TestRegisterDuplicates:
+    @pytest.fixture(autouse=True)
+    def no_supabase(self, monkeypatch):
+        import main
+
+        def fail():
+            raise AssertionError("Supabase should not be called for a duplicate")
+        monkeypatch.setattr(main, "get_supabase", fail)
+
+    def test_taken_username(self, client):
+        r = client.post("/register", data={
+            "username": "testuser", "email": "new@test.com", "password": "secret123",
+        })
+        assert r.status_code == 200
+        assert b"Username already taken." in r.data
+
+    def test_taken_email(self, client):
+        r = client.post("/register", data={
+            "username": "brandnew", "email": "test@test.com", "password": "secret123",
+        })
+        assert r.status_code == 200
+        assert b"Email already registered." in r.data
+
+
+# ---------------------------------------------------------------------------
+# COMMON FOODS  in-memory index over the seeded CommonFood table
+# ---------------------------------------------------------------------------
+
+class TestCommonFoodSearch:
+    SEED = [
+        ("White rice, cooked", "white rice", 130),
+        ("Brown rice, cooked", "brown rice", 112),
+        ("Ice cream, vanilla", "ice cream", 207),
+        ("Egg, whole, raw", "egg", 143),
+        ("Peanut butter, smooth", "peanut butter", 588),
+    ]
+
+    @pytest.fixture(autouse=True)
+    def seeded(self, test_app, monkeypatch):
+        import main
+        with test_app.app_context():
+            for name, simple, kcal in self.SEED:
+                db.session.add(main.CommonFood(name=name, name_simple=simple, calories=kcal))
+            db.session.commit()
+            monkeypatch.setattr(main, "_common_food_index", None)
+            yield main
+            main.CommonFood.query.delete()
+            db.session.commit()
+
+    def names(self, main, query):
+        return [p["name"] for p in main.search_common_foods(query)]
+
+    def test_substring_matches_mid_word(self, seeded):
+        assert self.names(seeded, "ice") == [
+            "White rice, cooked", "Brown rice, cooked", "Ice cream, vanilla",
+        ]
+
+    def test_two_char_query_matches(self, seeded):
+        assert self.names(seeded, "eg") == ["Egg, whole, raw"]
+
+    def test_ten_char_query_matches(self, seeded):
+        assert self.names(seeded, "nut butter") == ["Peanut butter, smooth"]
+
+    def test_query_longer_than_slice_map_uses_trigrams(self, seeded):
+        query = "peanut butter"
+        assert len(query) > seeded.COMMON_MATCH_MAX
+        assert query not in seeded.get_common_food_index()[2]
+        assert self.names(seeded, query) == ["Peanut butter, smooth"]
+        assert self.names(seeded, "peanut butters") == []
+
+    def test_like_wildcards_are_literal(self, seeded):
+        assert self.names(seeded, "%") == []
+        assert self.names(seeded, "r_ce") == []
+
+    def test_results_are_copies(self, seeded):
+        seeded.search_common_foods("egg")[0].pop("_source")
+        assert seeded.search_common_foods("egg")[0]["_source"] == "common"
+
+    def test_common_food_wins_merge(self, seeded, logged_in_client, monkeypatch):
+        import food_apis
+        api_dupe = {**TestSearchCache.PRODUCT, "name": "White rice, cooked",
+                    "brand": "Generic", "calories": 999}
+        api_other = {**TestSearchCache.PRODUCT, "name": "Rice", "brand": "Acme"}
+        monkeypatch.setattr(food_apis, "search_foods",
+                            lambda q: [dict(api_dupe), dict(api_other)])
+
+        products = logged_in_client.get("/api/food/search?q=white rice").get_json()["products"]
+        assert [p["name"] for p in products] == ["White rice, cooked", "Rice"]
+        assert products[0]["calories"] == 130
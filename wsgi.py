@@ -0,0 +1,6 @@
+"""
+WSGI entrypoint for production servers (gunicorn, waitress)
+"""
+from main import app
+
+# gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:8000 wsgi:app